@@ -1,25 +1,128 @@
+import functools
+import hashlib
+import inspect
 import json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from abc import ABC, abstractmethod
-from io import StringIO
 from os.path import exists
 
-import scipy
+import scipy.sparse
 from evomol.evaluation_dft import rdkit_mm_xyz, obabel_mmff94_xyz
 from evomol.evaluation_entropy import extract_shingles
 from sklearn.base import TransformerMixin, BaseEstimator
 from dscribe.descriptors import SOAP, CoulombMatrix, MBTR
-from joblib import Parallel, delayed, Memory
+from joblib import Parallel, delayed, Memory, effective_n_jobs
 from rdkit.Chem.rdchem import GetPeriodicTable
 from rdkit.Chem.rdmolfiles import MolToSmiles, MolFromSmiles
 import numpy as np
-from ase.io import read as read_ase
+from ase import Atoms
 import tqdm
 
 
+@functools.lru_cache(maxsize=100000)
+def _canonical_smiles(smiles):
+    """
+    Returning the RDKit canonical SMILES of the given SMILES. The results are memoized, as the same molecules are
+    usually transformed several times.
+    :param smiles: SMILES
+    :return: canonical SMILES, or None if the SMILES cannot be parsed
+    """
+    mol = MolFromSmiles(smiles)
+    return MolToSmiles(mol) if mol is not None else None
+
+
+def bool_mask(packed_successes, n_mol):
+    """
+    Converting the successes bitmap returned by transform when packed_successes is True to a boolean array
+    :param packed_successes: np.uint8 array in which the success of molecule i is the bit i & 7 of byte i >> 3
+    :param n_mol: number of molecules
+    :return: boolean array of size n_mol
+    """
+    return np.unpackbits(packed_successes, count=n_mol, bitorder="little").astype(bool)
+
+
+def _parse_xyz_fast(xyz_str):
+    """
+    Converting the given XYZ string to an ASE.Atoms object. Minimal parser for the XYZ strings produced by the MM
+    programs, much faster than ase.io.read for small molecules.
+    :param xyz_str: XYZ string (number of atoms, comment line, then one line per atom with symbol and coordinates)
+    :return: ase.Atoms
+    """
+
+    lines = xyz_str.split("\n")
+    n_atoms = int(lines[0])
+
+    atom_lines = lines[2:2 + n_atoms]
+    n_cols = len(atom_lines[0].split()) if n_atoms > 0 else 4
+
+    # Tokenizing the whole atoms block at once (one row per atom, with possible extra columns after the coordinates)
+    tokens = np.array(" ".join(atom_lines).split())
+
+    if tokens.size == n_atoms * n_cols:
+        tokens = tokens.reshape((n_atoms, n_cols))
+    else:
+        # Irregular number of columns : tokenizing each atom line
+        tokens = np.array([line.split()[:4] for line in atom_lines])
+
+    symbols = tokens[:, 0].tolist()
+    positions = tokens[:, 1:4].astype(np.float64)
+
+    return Atoms(symbols=symbols, positions=positions)
+
+
+@functools.lru_cache(maxsize=None)
+def _function_fingerprint(func):
+    """
+    Returning an immutable fingerprint identifying the given function by its module, qualified name and code, so
+    that the joblib.Memory entries computed with another function or with an older version of its code are not reused
+    :param func: Python function
+    :return: tuple (module, qualified name, SHA-1 of the source code)
+    """
+
+    try:
+        code = inspect.getsource(func)
+    except (OSError, TypeError):
+        # Source code not available (e.g. function defined in an interactive session)
+        code = func.__code__.co_code.hex() if hasattr(func, "__code__") else ""
+
+    return func.__module__, func.__qualname__, hashlib.sha1(code.encode()).hexdigest()
+
+
+def _compute_ase_geometry(geometry_function, smiles, param_fingerprint, geometry_function_parameters):
+    """
+    Computing the MM geometry of the given SMILES with the given function and converting it to an ASE.Atoms object
+    :param geometry_function: function returning a tuple (XYZ string, success status) for a SMILES
+    :param smiles: SMILES of the molecule
+    :param param_fingerprint: immutable tuple identifying the geometry function, the XYZ parser and the parameters of
+    the geometry function (only argument identifying the computation in the joblib.Memory cache along with the SMILES)
+    :param geometry_function_parameters: dictionary of parameters given to the geometry function
+    :return: (ase.Atoms, success status)
+    """
+
+    xyz_str, success = geometry_function(smiles, **geometry_function_parameters)
+
+    if success:
+        ase_atoms = _parse_xyz_fast(xyz_str)
+    else:
+        ase_atoms = None
+
+    return ase_atoms, success
+
+
 class Descriptor(TransformerMixin, BaseEstimator, ABC):
 
+    # Whether the runtime of the parallel tasks varies a lot between molecules (MM geometry optimization)
+    _expect_heterogeneous = True
+
+    # joblib.Memory objects (indexed by cache location) and cached functions (indexed by (cache location, function
+    # name)) shared by all instances
+    _shared_memory_cache = {}
+    _shared_cached_functions = {}
+
     def __init__(self, cache_location=None, n_jobs=1, batch_size='auto', pre_dispatch='2 * n_jobs',
-                 MM_program="obabel_mmff94", MM_program_parameters=None, disable_tqdm=False):
+                 MM_program="obabel_mmff94", MM_program_parameters=None, disable_tqdm=False, dtype=np.float32,
+                 geometry_backend="joblib", packed_successes=False, mem_cache_size=0):
         """
         :param cache_location: path of the joblib.Memory data
         :param n_jobs: number of jobs used for parallel computation of the descriptors
@@ -29,6 +132,15 @@ class Descriptor(TransformerMixin, BaseEstimator, ABC):
             - "rdkit_uff" to compute MM with RDKit using the UFF force field
         :param MM_program_parameters: parameters to be given to the MM programm function:
         :param disable_tqdm: whether to disable tqdm output (progress bar)
+        :param dtype: data type of the descriptors (np.float32 by default, np.float64 for double precision)
+        :param geometry_backend: how the geometries are computed in parallel. Options :
+            - "joblib" to dispatch the molecules with joblib
+            - "process_pool" to dispatch chunks of molecules with a concurrent.futures.ProcessPoolExecutor, which
+            amortizes the inter-process communication cost for short MM computations
+        :param packed_successes: whether transform returns the successes as a bitmap packed in a np.uint8 array (see
+        bool_mask) instead of a boolean array
+        :param mem_cache_size: maximum number of molecules whose descriptors are kept in an in-memory LRU cache, to
+        avoid recomputing them when the same molecules are transformed again (0 to disable the cache)
         """
 
         if MM_program == "obabel" or MM_program == "obabel_mmff94":
@@ -38,9 +150,9 @@ class Descriptor(TransformerMixin, BaseEstimator, ABC):
         elif callable(MM_program):
             self.geometry_function = MM_program
 
-        self.cache_geom_fun = Memory(cache_location,
-                                     verbose=0).cache(self.geometry_function)
         self.cache_location = cache_location
+        self.cache_geom_fun = self.get_cached_function(_compute_ase_geometry,
+                                                       ignore=["geometry_function", "geometry_function_parameters"])
         self.n_jobs = n_jobs
         self.batch_size = batch_size
         self.pre_dispatch = pre_dispatch
@@ -56,10 +168,98 @@ class Descriptor(TransformerMixin, BaseEstimator, ABC):
 
         self.geometry_function_parameters = geometry_function_parameters
 
+        # Parameters actually given to the geometry function, and immutable fingerprint identifying the geometry
+        # computation in the caches (computed once to avoid rehashing them for each molecule). The geometry function
+        # and the XYZ parser are identified by their module, name and code
+        self._geom_function_fingerprint = (_function_fingerprint(self.geometry_function),
+                                           _function_fingerprint(_parse_xyz_fast))
+        if MM_program == "rdkit_uff":
+            self._geometry_call_parameters = dict(geometry_function_parameters, ff="UFF")
+        else:
+            self._geometry_call_parameters = geometry_function_parameters
+        self._param_fingerprint = (self._geom_function_fingerprint,
+                                   tuple(sorted(self._geometry_call_parameters.items())))
+
         self.disable_tqdm = disable_tqdm
+        self.dtype = dtype
+        self.geometry_backend = geometry_backend
+        self.packed_successes = packed_successes
+
+        # In-memory LRU cache of the descriptors (not zero-padded), indexed by (canonical SMILES, self._param_hash). The
+        # keys are only computed if the cache is enabled
+        self.mem_cache_size = mem_cache_size
+        self._mem_cache = OrderedDict()
+        self._param_hash = self._param_fingerprint
 
         print("MM program : " + str(MM_program))
 
+    def __getstate__(self):
+        # The in-memory cache is not sent to the parallel workers
+        state = dict(super().__getstate__())
+        state["_mem_cache"] = OrderedDict()
+        return state
+
+    def cache_lookup(self, smiles):
+        """
+        Returning the (descriptor, success) tuple recorded in the in-memory cache for the given SMILES. The descriptor
+        is a copy, so that the cache cannot be modified through the returned arrays.
+        :param smiles: SMILES of the molecule
+        :return: (descriptor, success) tuple, or None if the molecule is not in cache or if the cache is disabled
+        """
+
+        if self.mem_cache_size <= 0:
+            return None
+
+        key = (_canonical_smiles(smiles), self._param_hash)
+
+        if key not in self._mem_cache:
+            return None
+
+        self._mem_cache.move_to_end(key)
+        desc, success = self._mem_cache[key]
+
+        return (desc.copy() if desc is not None else None), success
+
+    def cache_record(self, smiles, desc, success):
+        """
+        Recording a copy of the given descriptor in the in-memory cache, and removing the least recently used entries
+        if the cache exceeds self.mem_cache_size. Nothing is done if the cache is disabled.
+        :param smiles: SMILES of the molecule
+        :param desc: descriptor of the molecule (not zero-padded, None for a failed computation)
+        :param success: success of the computation
+        """
+
+        if self.mem_cache_size <= 0:
+            return
+
+        key = (_canonical_smiles(smiles), self._param_hash)
+        self._mem_cache[key] = ((desc.copy() if desc is not None else None), success)
+        self._mem_cache.move_to_end(key)
+
+        while len(self._mem_cache) > self.mem_cache_size:
+            self._mem_cache.popitem(last=False)
+
+    def get_cached_function(self, func, ignore=None):
+        """
+        Returning the given function cached with the joblib.Memory object of self.cache_location. The joblib.Memory
+        objects and the cached functions are created once and shared by all the instances (e.g. sklearn clones).
+        :param func: function to be cached
+        :param ignore: list of the names of the arguments to be ignored by the cache
+        :return: joblib cached function
+        """
+
+        key = (self.cache_location, func.__module__ + "." + func.__qualname__)
+
+        if key not in Descriptor._shared_cached_functions:
+
+            if self.cache_location not in Descriptor._shared_memory_cache:
+                Descriptor._shared_memory_cache[self.cache_location] = Memory(self.cache_location, verbose=0)
+
+            Descriptor._shared_cached_functions[key] = Descriptor._shared_memory_cache[self.cache_location].cache(
+                func, ignore=ignore)
+
+        return Descriptor._shared_cached_functions[key]
+
     def fit(self, X, y=None):
         return self
 
@@ -92,48 +292,106 @@ class Descriptor(TransformerMixin, BaseEstimator, ABC):
 
         return n_mol, self.get_row_size()
 
+    def get_parallel(self):
+        """
+        Returning the joblib.Parallel object used to perform parallel computations. The results are returned as a
+        generator in submission order. If the runtime of the tasks is heterogeneous and no batch size is set, the tasks
+        are dispatched one by one so that slow molecules do not stall whole batches.
+        :return: joblib.Parallel object
+        """
+
+        batch_size = 1 if self._expect_heterogeneous and self.batch_size == 'auto' else self.batch_size
+
+        return Parallel(n_jobs=self.n_jobs, backend="loky", batch_size=batch_size, pre_dispatch=self.pre_dispatch,
+                        return_as="generator")
+
     def transform(self, X):
-        # Performing a parallel computation of the descriptor
-        results_parallel = Parallel(n_jobs=self.n_jobs, batch_size=self.batch_size, pre_dispatch=self.pre_dispatch)(
-            delayed(self.transform_row)(X[i]) for i in tqdm.tqdm(range(len(X)), disable=self.disable_tqdm))
 
-        results = np.zeros((self.descriptors_shape(len(X))))
+        # Computing the descriptor of each distinct molecule (in RDKit canonical form) only once. The SMILES that
+        # cannot be parsed are not computed
+        canonical_smiles = [_canonical_smiles(smi) for smi in X]
+        unique_smiles = [smi for smi in dict.fromkeys(canonical_smiles) if smi is not None]
+
+        results, successes_comput = self.transform_unique(unique_smiles)
+
+        # Returning the results as they are if there is no duplicate nor unparsable SMILES
+        if len(unique_smiles) == len(canonical_smiles):
+            return results, self.format_successes(successes_comput)
+
+        # Mapping every molecule to the row of its distinct canonical SMILES (-1 for unparsable SMILES)
+        unique_idx = {smi: i for i, smi in enumerate(unique_smiles)}
+        inverse = np.array([unique_idx.get(smi, -1) for smi in canonical_smiles], dtype=np.int64)
+        parsed = inverse >= 0
+
+        if parsed.all():
+            return results[inverse], self.format_successes(successes_comput[inverse])
+
+        # Unparsable SMILES are described by a zero row and a failed computation
+        successes = np.full((len(X),), False)
+        successes[parsed] = successes_comput[inverse[parsed]]
+
+        if scipy.sparse.issparse(results):
+            selection = scipy.sparse.csr_matrix(
+                (np.ones(parsed.sum(), dtype=self.dtype), (np.flatnonzero(parsed), inverse[parsed])),
+                shape=(len(X), len(unique_smiles)))
+            results = (selection @ results).tocsr()
+        else:
+            all_results = np.zeros((len(X),) + results.shape[1:], dtype=results.dtype)
+            all_results[parsed] = results[inverse[parsed]]
+            results = all_results
+
+        return results, self.format_successes(successes)
+
+    def format_successes(self, successes):
+        """
+        Returning the given boolean successes array in the output format of transform
+        :param successes: boolean array
+        :return: boolean array, or bitmap packed in a np.uint8 array if self.packed_successes is True
+        """
+        return np.packbits(successes, bitorder="little") if self.packed_successes else successes
+
+    def transform_unique(self, X):
+        """
+        Transforming the given list of distinct SMILES. Called by transform, which maps the results back to the
+        submitted molecules.
+        :param X: list of distinct SMILES
+        :return: tuple (descriptors matrix, successes array)
+        """
+
+        results = np.zeros(self.descriptors_shape(len(X)), dtype=self.dtype)
         successes_comput = np.full((len(X),), False)
 
-        # Retrieving all parallel results
-        i = 0
-        for desc_row, success in results_parallel:
-            # Saving descriptor
+        # Performing a parallel computation of the descriptor and writing the results as they arrive
+        results_parallel = self.get_parallel()(
+            delayed(self.transform_row)(X[i]) for i in tqdm.tqdm(range(len(X)), disable=self.disable_tqdm))
+
+        for i, (desc_row, success) in enumerate(results_parallel):
             results[i] = desc_row
             successes_comput[i] = success
-            i += 1
 
         return results, successes_comput
 
     def compute_geometry(self, smiles):
         """
         Return an ASE.Atoms object set with the geometry represented as a XYZ string obtained using the
-        self.geometry_function
+        self.geometry_function. The ASE.Atoms object is directly stored in the joblib.Memory cache.
         :param smiles:
         :return: (ase.Atoms, success status)
         """
 
         # Making sure the SMILES is in RDKit canonical order
-        smiles = MolToSmiles(MolFromSmiles(smiles))
+        canonical_smiles = _canonical_smiles(smiles)
 
-        try:
+        if canonical_smiles is None:
+            print("Error while computing geometry : SMILES cannot be parsed; smi : " + str(smiles))
+            return None, False
 
-            if self.MM_program == "rdkit_uff":
-                xyz_str, success = self.cache_geom_fun(smiles, ff="UFF", **self.geometry_function_parameters)
-            else:
-                xyz_str, success = self.cache_geom_fun(smiles, **self.geometry_function_parameters)
+        smiles = canonical_smiles
 
-            if success:
-                f = StringIO(xyz_str)
-                ase_atoms = read_ase(f, format='xyz')
+        try:
 
-            else:
-                ase_atoms = None
+            ase_atoms, success = self.cache_geom_fun(self.geometry_function, smiles, self._param_fingerprint,
+                                                     self._geometry_call_parameters)
 
         except Exception as e:
             print("Error while computing geometry : " + str(e) + "; smi : " + smiles)
@@ -142,16 +400,223 @@ class Descriptor(TransformerMixin, BaseEstimator, ABC):
 
         return ase_atoms, success
 
+    def compute_geometries(self, X):
+        """
+        Parallel computation of the ASE.Atoms objects of all the given SMILES
+        :param X: list of SMILES
+        :return: (list of ASE.Atoms objects (None for failed computations), array of success status)
+        """
+
+        if len(X) == 0:
+            return [], np.full((0,), False)
+
+        if self.geometry_backend == "joblib":
+            results_parallel = list(self.get_parallel()(
+                delayed(self.compute_geometry)(X[i]) for i in tqdm.tqdm(range(len(X)), disable=self.disable_tqdm)))
+
+        elif self.geometry_backend == "process_pool":
+            n_workers = effective_n_jobs(self.n_jobs)
+
+            if n_workers == 1:
+                # Computing the geometries in the current process
+                results_parallel = [self.compute_geometry(smi) for smi in tqdm.tqdm(X, disable=self.disable_tqdm)]
+
+            else:
+                with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                    results_parallel = list(tqdm.tqdm(
+                        executor.map(self.compute_geometry, X, chunksize=max(1, len(X) // (n_workers * 4))),
+                        total=len(X), disable=self.disable_tqdm))
+
+        else:
+            raise ValueError("Unknown geometry backend : " + str(self.geometry_backend))
+
+        ase_mols, successes = zip(*results_parallel)
+
+        return list(ase_mols), np.asarray(successes, dtype=bool)
+
+    def descriptor_from_ase(self, ase_mol, smiles):
+        """
+        Computing the descriptor of a single molecule from its ASE.Atoms object. Must be implemented by descriptors
+        relying on transform_from_ase.
+        :param ase_mol: ASE.Atoms object
+        :param smiles: SMILES of the molecule
+        :return: tuple (descriptor, success of computation)
+        """
+        raise NotImplementedError()
+
+    def complete_row(self, desc, sparse=False):
+        """
+        Returning the given descriptor of a single molecule as a row of size self.get_row_size(), zero-padded if
+        needed
+        :param desc: descriptor of a single molecule (None for a failed computation)
+        :param sparse: whether to return a scipy.sparse.csr_matrix row instead of a dense array
+        :return: descriptor row
+        """
+
+        if sparse:
+            return _to_csr_row(desc, self.get_row_size(), dtype=self.dtype) if desc is not None \
+                else scipy.sparse.csr_matrix((1, self.get_row_size()), dtype=self.dtype)
+
+        if desc is None:
+            return np.zeros((self.get_row_size()), dtype=self.dtype)
+
+        desc = np.asarray(desc).reshape((-1,))
+
+        # No padding needed (e.g. averaged SOAP, CM, MBTR)
+        if len(desc) == self.get_row_size():
+            return desc.astype(self.dtype, copy=False)
+
+        row = np.zeros((self.get_row_size()), dtype=self.dtype)
+        row[:len(desc)] = desc
+
+        return row
+
+    def write_row(self, results, i, desc, sparse=False):
+        """
+        Writing the given descriptor of a single molecule in the row i of the given preallocated results
+        :param results: dense descriptors matrix, or list of scipy.sparse.csr_matrix rows if sparse is True
+        :param i: index of the row
+        :param desc: descriptor of the molecule (None for a failed computation)
+        :param sparse: whether the results are sparse rows
+        :return: written descriptor (view of the row without the zero-padding if dense), or None
+        """
+
+        if sparse:
+            results[i] = self.complete_row(desc, sparse=True)
+            return results[i]
+
+        if desc is None:
+            return None
+
+        # Flattening without copy for contiguous descriptors
+        desc = np.asarray(desc).reshape((-1,))
+        results[i, :len(desc)] = desc
+
+        return results[i, :len(desc)]
+
+    def transform_from_ase(self, X, builder, sparse=False):
+        """
+        Transforming the given SMILES with the given DScribe descriptor builder. The geometries are computed in
+        parallel, then all the descriptors are computed with a single call to the builder and written in the
+        preallocated results. The in-memory cache is looked up before any computation if it is enabled.
+        :param X: list of distinct SMILES
+        :param builder: DScribe descriptor object
+        :param sparse: whether the builder returns sparse descriptors. If so, the descriptors matrix is returned as a
+        scipy.sparse.csr_matrix
+        :return: tuple (descriptors matrix, successes array)
+        """
+
+        results = [None] * len(X) if sparse else np.zeros(self.descriptors_shape(len(X)), dtype=self.dtype)
+        successes_comput = np.full((len(X),), False)
+
+        # Written descriptors of the computed molecules, to be recorded in the in-memory cache
+        written = {}
+
+        # Looking up the cache and listing the molecules to be computed
+        missing_idx = []
+        for i, smi in enumerate(X):
+            cached = self.cache_lookup(smi)
+            if cached is None:
+                missing_idx.append(i)
+            else:
+                self.write_row(results, i, cached[0], sparse=sparse)
+                successes_comput[i] = cached[1]
+
+        # Computing MM and converting to ase.Atoms objects
+        ase_mols, successes = self.compute_geometries([X[i] for i in missing_idx])
+        valid_mols = [ase_mols[k] for k in np.flatnonzero(successes)]
+        valid_idx = [missing_idx[k] for k in np.flatnonzero(successes)]
+        successes_comput[valid_idx] = True
+
+        if len(valid_idx) > 0:
+
+            try:
+
+                if len(valid_mols) == 1:
+                    # DScribe returns the descriptor of a single system without batch dimension
+                    created_descs = [builder.create(valid_mols[0])]
+                else:
+                    # Computing all descriptors at once (DScribe fails if there are more jobs than systems)
+                    n_jobs = min(effective_n_jobs(self.n_jobs), len(valid_mols))
+                    created_descs = builder.create(valid_mols, n_jobs=n_jobs)
+
+                if not sparse and isinstance(created_descs, np.ndarray):
+
+                    # Descriptors of same size for all molecules : writing the whole batch in the preallocated rows
+                    created_descs = created_descs.reshape((len(valid_idx), -1))
+                    n_features = created_descs.shape[1]
+                    results[valid_idx, :n_features] = created_descs
+
+                    if self.mem_cache_size > 0:
+                        for i in valid_idx:
+                            written[i] = results[i, :n_features]
+
+                else:
+                    for i, desc in zip(valid_idx, created_descs):
+                        written[i] = self.write_row(results, i, desc, sparse=sparse)
+
+            except ValueError as e:
+
+                # Falling back to a computation molecule by molecule to isolate the failing ones
+                print("Batched descriptor computation failing (" + str(e) + "), computing molecules one by one")
+                for i, ase_mol in zip(valid_idx, valid_mols):
+                    desc, successes_comput[i] = self.descriptor_from_ase(ase_mol, X[i])
+                    written[i] = self.write_row(results, i, desc, sparse=sparse)
+
+        # Recording the computed descriptors in the in-memory cache
+        if self.mem_cache_size > 0:
+            for i in missing_idx:
+                self.cache_record(X[i], written.get(i), bool(successes_comput[i]))
+
+        if sparse:
+            empty_row = self.complete_row(None, sparse=True)
+            results = scipy.sparse.vstack([row if row is not None else empty_row for row in results], format="csr") \
+                if len(X) > 0 else scipy.sparse.csr_matrix(self.descriptors_shape(0), dtype=self.dtype)
+
+        return results, successes_comput
+
 
-def _CoulombMatrixDesc_compute_from_ASE(cm_builder, ase_mol, smiles, n_atoms_max, geom_function_name):
+def _to_csr_row(desc, row_size=None, dtype=np.float32):
+    """
+    Converting the given descriptor of a single molecule (dense array, scipy.sparse matrix or sparse.COO array as
+    returned by DScribe) to a flattened scipy.sparse.csr_matrix row
+    :param desc: descriptor of a single molecule
+    :param row_size: size of the output row (the descriptor is zero-padded). If None, the size of the flattened
+    descriptor is used
+    :param dtype: data type of the output row
+    :return: scipy.sparse.csr_matrix of shape (1, row_size)
+    """
+
+    if scipy.sparse.issparse(desc):
+        desc = desc.tocoo()
+        shape = desc.shape
+        cols = np.ravel_multi_index((desc.row, desc.col), shape)
+        data = desc.data
+    elif hasattr(desc, "coords"):
+        shape = desc.shape
+        cols = np.ravel_multi_index(desc.coords, shape)
+        data = desc.data
+    else:
+        desc = np.asarray(desc)
+        shape = desc.shape
+        cols = np.flatnonzero(desc)
+        data = desc.reshape((-1,))[cols]
+
+    if row_size is None:
+        row_size = int(np.prod(shape))
+
+    return scipy.sparse.csr_matrix((data, (np.zeros(len(cols), dtype=int), cols)), shape=(1, row_size), dtype=dtype)
+
+
+def _CoulombMatrixDesc_compute_from_ASE(cm_builder, ase_mol, smiles, dtype=np.float32):
     try:
 
-        cm_desc = cm_builder.create(ase_mol).reshape((-1,))
+        cm_desc = cm_builder.create(ase_mol).reshape((-1,)).astype(dtype, copy=False)
         success = True
 
     except Exception:
         print("CM failing for " + smiles)
-        cm_desc = np.zeros((cm_builder.get_number_of_features()))
+        cm_desc = np.zeros((cm_builder.get_number_of_features()), dtype=dtype)
         success = False
 
     return cm_desc, success
@@ -160,7 +625,8 @@ def _CoulombMatrixDesc_compute_from_ASE(cm_builder, ase_mol, smiles, n_atoms_max
 class CoulombMatrixDesc(Descriptor):
 
     def __init__(self, cache_location=None, n_atoms_max=100, n_jobs=1, batch_size='auto', pre_dispatch='2 * n_jobs',
-                 MM_program="obabel_mmff94", MM_program_parameters=None):
+                 MM_program="obabel_mmff94", MM_program_parameters=None, dtype=np.float32,
+                 geometry_backend="joblib", packed_successes=False, mem_cache_size=0):
         """
 
         Lauri Himanen et al., « DScribe: Library of Descriptors for Machine Learning in Materials Science »,
@@ -168,9 +634,15 @@ class CoulombMatrixDesc(Descriptor):
 
         :param n_atoms_max:
         :param n_jobs:
+        :param dtype: data type of the descriptors
+        :param geometry_backend: how the geometries are computed in parallel ("joblib" or "process_pool")
+        :param packed_successes: whether to return the successes as a packed bitmap (see bool_mask)
+        :param mem_cache_size: maximum number of molecules kept in the in-memory descriptors cache (0 to disable it)
         """
         super().__init__(cache_location=cache_location, n_jobs=n_jobs, batch_size=batch_size, pre_dispatch=pre_dispatch,
-                         MM_program=MM_program, MM_program_parameters=MM_program_parameters)
+                         MM_program=MM_program, MM_program_parameters=MM_program_parameters, dtype=dtype,
+                         geometry_backend=geometry_backend, packed_successes=packed_successes,
+                         mem_cache_size=mem_cache_size)
 
         # Parameters
         self.n_atoms_max = n_atoms_max
@@ -180,10 +652,8 @@ class CoulombMatrixDesc(Descriptor):
             n_atoms_max=self.n_atoms_max,
         )
 
-        # Setting up the cache object
-        self.cache_desc_fun = Memory(location=cache_location,
-                                     verbose=0).cache(_CoulombMatrixDesc_compute_from_ASE,
-                                                      ignore=["cm_builder", "ase_mol"])
+        # Identifying the descriptor parameters in the in-memory cache
+        self._param_hash = self._param_fingerprint + (self.n_atoms_max,)
 
     def get_row_size(self):
         return self.cm.get_number_of_features()
@@ -191,35 +661,49 @@ class CoulombMatrixDesc(Descriptor):
     def min_row_size(self):
         return self.get_row_size()
 
+    def descriptor_from_ase(self, ase_mol, smiles):
+        return _CoulombMatrixDesc_compute_from_ASE(self.cm, ase_mol, smiles, dtype=self.dtype)
+
     def transform_row(self, smiles):
 
+        cached = self.cache_lookup(smiles)
+        if cached is not None:
+            return cached
+
         # Computing MM and converting to ase.Atoms object
         ase_mol, ase_success = self.compute_geometry(smiles)
 
         if ase_success:
 
             # Computing CM descriptor
-            cm_desc, cm_success = self.cache_desc_fun(self.cm, ase_mol, smiles, self.n_atoms_max,
-                                                      self.geometry_function.__name__)
+            cm_desc, cm_success = self.descriptor_from_ase(ase_mol, smiles)
 
         else:
 
-            cm_desc = np.zeros((self.get_row_size()))
+            cm_desc = np.zeros((self.get_row_size()), dtype=self.dtype)
             cm_success = False
 
+        self.cache_record(smiles, cm_desc, ase_success and cm_success)
+
         return cm_desc, ase_success and cm_success
 
+    def transform_unique(self, X):
+        return self.transform_from_ase(X, self.cm)
+
 
-def _SOAPDesc_compute_from_ASE(soap_builder, ase_mol, smiles, rcut, nmax, lmax, species, average, n_atoms_max,
-                               geom_function_name):
+def _SOAPDesc_compute_from_ASE(soap_builder, ase_mol, smiles, sparse=False, dtype=np.float32):
     try:
 
-        soap_desc = soap_builder.create(ase_mol).reshape((-1,))
+        soap_desc = soap_builder.create(ase_mol)
+        soap_desc = _to_csr_row(soap_desc, dtype=dtype) if sparse \
+            else soap_desc.reshape((-1,)).astype(dtype, copy=False)
         success = True
 
     except Exception:
         print("SOAP failing for " + smiles)
-        soap_desc = np.zeros((soap_builder.get_number_of_features()))
+        n_features = soap_builder.get_number_of_features()
+        soap_desc = scipy.sparse.csr_matrix((1, n_features), dtype=dtype) if sparse \
+            else np.zeros((n_features), dtype=dtype)
         success = False
 
     return soap_desc, success
@@ -229,7 +713,8 @@ class SOAPDesc(Descriptor):
 
     def __init__(self, cache_location=None, rcut=6.0, nmax=8, lmax=6, species="default", average="inner", n_jobs=1,
                  batch_size='auto', pre_dispatch='2 * n_jobs', n_atoms_max=None, MM_program="obabel_mmff94",
-                 MM_program_parameters=None):
+                 MM_program_parameters=None, sparse=False, dtype=np.float32, geometry_backend="joblib",
+                 packed_successes=False, mem_cache_size=0):
         """
         SOAP descriptor
 
@@ -246,14 +731,23 @@ class SOAPDesc(Descriptor):
         :param average: Whether to perform an averaging of the environment to represent global structure ("inner",
         "outer", "off")
         :param n_jobs: Maximum number of threads for parallel computation
+        :param sparse: whether to compute sparse descriptors (see DScribe). If True, the descriptors matrix is returned
+        as a scipy.sparse.csr_matrix, which avoids storing the zero-padding when average is "off"
+        :param dtype: data type of the descriptors
+        :param geometry_backend: how the geometries are computed in parallel ("joblib" or "process_pool")
+        :param packed_successes: whether to return the successes as a packed bitmap (see bool_mask)
+        :param mem_cache_size: maximum number of molecules kept in the in-memory descriptors cache (0 to disable it)
         """
         super().__init__(cache_location=cache_location, n_jobs=n_jobs, batch_size=batch_size, pre_dispatch=pre_dispatch,
-                         MM_program=MM_program, MM_program_parameters=MM_program_parameters)
+                         MM_program=MM_program, MM_program_parameters=MM_program_parameters, dtype=dtype,
+                         geometry_backend=geometry_backend, packed_successes=packed_successes,
+                         mem_cache_size=mem_cache_size)
         self.rcut = rcut
         self.nmax = nmax
         self.lmax = lmax
         self.species = ["H", "C", "O", "N", "F"] if species == "default" else species
         self.average = average
+        self.sparse = sparse
 
         if average == "off" and n_atoms_max is None:
             self.n_atoms_max = 100
@@ -267,13 +761,13 @@ class SOAPDesc(Descriptor):
             rcut=self.rcut,
             nmax=self.nmax,
             lmax=self.lmax,
-            average=self.average
+            average=self.average,
+            sparse=self.sparse
         )
 
-        # Setting up the cache object
-        self.cache_desc_fun = Memory(location=cache_location,
-                                     verbose=0).cache(_SOAPDesc_compute_from_ASE,
-                                                      ignore=["soap_builder", "ase_mol"])
+        # Identifying the descriptor parameters in the in-memory cache
+        self._param_hash = self._param_fingerprint + (self.rcut, self.nmax, self.lmax, tuple(self.species),
+                                                        self.average, self.n_atoms_max, self.sparse)
 
     def get_row_size(self):
         if self.average == "off":
@@ -284,42 +778,49 @@ class SOAPDesc(Descriptor):
     def min_row_size(self):
         return self.get_row_size()
 
+    def descriptor_from_ase(self, ase_mol, smiles):
+        return _SOAPDesc_compute_from_ASE(self.soap, ase_mol, smiles, sparse=self.sparse, dtype=self.dtype)
+
     def transform_row(self, smiles):
 
-        # Computing MM and converting to ase.Atoms object
-        ase_mol, ase_success = self.compute_geometry(smiles)
+        cached = self.cache_lookup(smiles)
 
-        if ase_success:
+        if cached is not None:
+            soap_desc, success = cached
+
+        else:
 
-            complete_desc = np.zeros((self.get_row_size()))
+            # Computing MM and converting to ase.Atoms object
+            ase_mol, ase_success = self.compute_geometry(smiles)
 
-            # Computing descriptor
-            soap_desc, soap_success = self.cache_desc_fun(self.soap, ase_mol, smiles, rcut=self.rcut, nmax=self.nmax,
-                                                          lmax=self.lmax, species=self.species, average=self.average,
-                                                          n_atoms_max=self.n_atoms_max,
-                                                          geom_function_name=self.geometry_function.__name__)
+            if ase_success:
 
-            complete_desc[:len(soap_desc)] = soap_desc
-            soap_desc = complete_desc
+                # Computing descriptor
+                soap_desc, soap_success = self.descriptor_from_ase(ase_mol, smiles)
 
-        else:
+            else:
+
+                soap_desc = None
+                soap_success = False
+
+            success = ase_success and soap_success
+            self.cache_record(smiles, soap_desc, success)
 
-            soap_desc = np.zeros((self.get_row_size()))
-            soap_success = False
+        return self.complete_row(soap_desc, sparse=self.sparse), success
 
-        return soap_desc, ase_success and soap_success
+    def transform_unique(self, X):
+        return self.transform_from_ase(X, self.soap, sparse=self.sparse)
 
 
-def _MBTRDesc_compute_from_ASE(mbtr_builder, ase_mol, smiles, species, atomic_numbers_n, inverse_distances_n,
-                               cosine_angles_n, normalization, geom_function_name):
+def _MBTRDesc_compute_from_ASE(mbtr_builder, ase_mol, smiles, dtype=np.float32):
     try:
 
-        cm_desc = mbtr_builder.create(ase_mol).reshape((-1,))
+        cm_desc = mbtr_builder.create(ase_mol).reshape((-1,)).astype(dtype, copy=False)
         success = True
 
     except Exception as e:
         print("MBTR failing for " + smiles)
-        cm_desc = np.zeros((mbtr_builder.get_number_of_features()))
+        cm_desc = np.zeros((mbtr_builder.get_number_of_features()), dtype=dtype)
         success = False
 
     return cm_desc, success
@@ -329,7 +830,8 @@ class MBTRDesc(Descriptor):
 
     def __init__(self, cache_location=None, species="default", n_jobs=1, batch_size='auto', pre_dispatch='2 * n_jobs',
                  atomic_numbers_n=100, inverse_distances_n=100, cosine_angles_n=100, MM_program="obabel",
-                 MM_program_parameters=None):
+                 MM_program_parameters=None, dtype=np.float32, geometry_backend="joblib", packed_successes=False,
+                 mem_cache_size=0):
         """
         MBTR descriptor
 
@@ -344,9 +846,15 @@ class MBTRDesc(Descriptor):
         :param atomic_numbers_n: Number of samples to encode atomic numbers in MBTR (see DScribe)
         :param inverse_distances_n: Number of samples to encode inverse distances in MBTR (see DScribe)
         :param cosine_angles_n: Number of samples to encode angles in MBTR (see DScribe)
+        :param dtype: data type of the descriptors
+        :param geometry_backend: how the geometries are computed in parallel ("joblib" or "process_pool")
+        :param packed_successes: whether to return the successes as a packed bitmap (see bool_mask)
+        :param mem_cache_size: maximum number of molecules kept in the in-memory descriptors cache (0 to disable it)
         """
         super().__init__(cache_location=cache_location, n_jobs=n_jobs, batch_size=batch_size, pre_dispatch=pre_dispatch,
-                         MM_program=MM_program, MM_program_parameters=MM_program_parameters)
+                         MM_program=MM_program, MM_program_parameters=MM_program_parameters, dtype=dtype,
+                         geometry_backend=geometry_backend, packed_successes=packed_successes,
+                         mem_cache_size=mem_cache_size)
 
         self.species = ["H", "C", "O", "N", "F"] if species == "default" else species
         self.atomic_numbers_n = atomic_numbers_n
@@ -384,10 +892,10 @@ class MBTRDesc(Descriptor):
             normalization=self.normalization,
         )
 
-        # Setting up the cache object
-        self.cache_desc_fun = Memory(location=cache_location,
-                                     verbose=0).cache(_MBTRDesc_compute_from_ASE,
-                                                      ignore=["mbtr_builder", "ase_mol"])
+        # Identifying the descriptor parameters in the in-memory cache
+        self._param_hash = self._param_fingerprint + (tuple(self.species), self.atomic_numbers_n,
+                                                        self.inverse_distances_n, self.cosine_angles_n,
+                                                        self.normalization)
 
     def get_row_size(self):
         return self.mbtr.get_number_of_features()
@@ -395,31 +903,43 @@ class MBTRDesc(Descriptor):
     def min_row_size(self):
         return self.get_row_size()
 
+    def descriptor_from_ase(self, ase_mol, smiles):
+        return _MBTRDesc_compute_from_ASE(self.mbtr, ase_mol, smiles, dtype=self.dtype)
+
     def transform_row(self, smiles):
 
+        cached = self.cache_lookup(smiles)
+        if cached is not None:
+            return cached
+
         # Computing MM and converting to ase.Atoms object
         ase_mol, ase_success = self.compute_geometry(smiles)
 
         if ase_success:
 
             # Computing descriptor
-            mbtr_desc, mbtr_success = self.cache_desc_fun(self.mbtr, ase_mol, smiles, species=self.species,
-                                                          atomic_numbers_n=self.atomic_numbers_n,
-                                                          inverse_distances_n=self.inverse_distances_n,
-                                                          cosine_angles_n=self.cosine_angles_n,
-                                                          normalization=self.normalization,
-                                                          geom_function_name=self.geometry_function.__name__)
+            mbtr_desc, mbtr_success = self.descriptor_from_ase(ase_mol, smiles)
+
         else:
 
-            mbtr_desc = np.zeros((self.get_row_size()))
+            mbtr_desc = np.zeros((self.get_row_size()), dtype=self.dtype)
             mbtr_success = False
 
+        self.cache_record(smiles, mbtr_desc, ase_success and mbtr_success)
+
         return mbtr_desc, ase_success and mbtr_success
 
+    def transform_unique(self, X):
+        return self.transform_from_ase(X, self.mbtr)
+
 
 class ShinglesVectDesc(Descriptor):
 
-    def __init__(self, cache_location=None, lvl=1, vect_size=4000, count=False, external_desc_id_dict=None):
+    _expect_heterogeneous = False
+
+    def __init__(self, cache_location=None, lvl=1, vect_size=4000, count=False, external_desc_id_dict=None, n_jobs=1,
+                 batch_size='auto', pre_dispatch='2 * n_jobs', sparse_output=True, dtype=np.float32,
+                 packed_successes=False):
         """
         Shingles vector descriptor. Representing the molecule in the form of a boolean vector (or a count vector) of
         shingles of radius 1 to lvl.
@@ -428,7 +948,8 @@ class ShinglesVectDesc(Descriptor):
         Journal of Cheminformatics 10, nᵒ 1 (décembre 2018), https://doi.org/10.1186/s13321-018-0321-8.
 
         Due to the fact that the mapping between shingles and identifiers depends on the order of submitted molecules,
-        no parallel computation is proposed.
+        only the extraction of shingles is performed in parallel. The identifiers are then assigned sequentially in the
+        order of submitted molecules.
         For the same reason, this object records data in a temporary cache that won't be shared between
         executions.
 
@@ -437,8 +958,14 @@ class ShinglesVectDesc(Descriptor):
         :param count: whether to count the number of shingles or to indicate their boolean presence
         :param external_desc_id_dict: external dictionary or path to an external dictionary that maps a shingle smiles
         with an integer id that is used as index in the output descriptor vector
+        :param n_jobs: number of jobs used for parallel extraction of the shingles
+        :param sparse_output: whether to return the descriptors matrix as a scipy.sparse.csr_matrix (default) or as a
+        dense array
+        :param dtype: data type of the descriptors
+        :param packed_successes: whether to return the successes as a packed bitmap (see bool_mask)
         """
-        super().__init__(cache_location=cache_location)
+        super().__init__(cache_location=cache_location, n_jobs=n_jobs, batch_size=batch_size, pre_dispatch=pre_dispatch,
+                         dtype=dtype, packed_successes=packed_successes)
 
         if isinstance(external_desc_id_dict, str) and exists(external_desc_id_dict):
             with open(external_desc_id_dict, "r") as f:
@@ -452,12 +979,17 @@ class ShinglesVectDesc(Descriptor):
         self.next_id = 0 if external_desc_id_dict is None else max(external_desc_id_dict.values()) + 1
         self.desc_id_dict = {} if external_desc_id_dict is None else external_desc_id_dict
         self.count = count
+        self.sparse_output = sparse_output
 
         # Setting up the cache object
-        self.cache_desc_fun = Memory(location=cache_location,
-                                     verbose=0).cache(extract_shingles)
+        self.cache_desc_fun = self.get_cached_function(extract_shingles)
 
     def get_row_size(self):
+        """
+        Returning the size of the vector describing one molecule. If self.sparse_output is True, the rows are returned
+        as a scipy.sparse.csr_matrix with this number of columns
+        :return:
+        """
         return self.vect_size
 
     def min_row_size(self):
@@ -476,35 +1008,77 @@ class ShinglesVectDesc(Descriptor):
 
     def transform(self, X):
 
-        desc = np.zeros((len(X), self.vect_size))
+        # Extracting the shingles of all molecules in parallel
+        shingles_lists = self.get_parallel()(
+            delayed(self.cache_desc_fun)(smi, self.lvl, as_list=self.count)
+            for smi in tqdm.tqdm(X, disable=self.disable_tqdm))
+
+        # Assigning the identifiers sequentially, in the order of submitted molecules (as they arrive)
+        ids_list = [np.fromiter((self.get_desc_id(shg) for shg in found_shingles), dtype=np.int64,
+                                count=len(found_shingles)) for found_shingles in shingles_lists]
+
+        # Computing the (row, column) coordinates of all shingles
+        rows = np.repeat(np.arange(len(X)), [len(ids) for ids in ids_list])
+        cols = np.concatenate(ids_list) if len(ids_list) > 0 else np.zeros((0,), dtype=np.int64)
+
+        if len(cols) > 0 and cols.max() >= self.vect_size:
+            raise IndexError("The number of shingles exceeds the vector size (" + str(self.vect_size) + ")")
+
+        # Building the descriptors matrix (duplicate entries are summed)
+        if self.sparse_output:
+            desc = scipy.sparse.csr_matrix((np.ones(len(cols), dtype=self.dtype), (rows, cols)),
+                                           shape=(len(X), self.vect_size), dtype=self.dtype)
+            desc.sum_duplicates()
+        else:
+            desc = np.zeros((len(X), self.vect_size), dtype=self.dtype)
+            np.add.at(desc, (rows, cols), 1)
 
-        for i, smi in enumerate(tqdm.tqdm(X, disable=self.disable_tqdm)):
+        return desc, self.format_successes(np.full((len(X),), True))
 
-            found_shingles = self.cache_desc_fun(smi, self.lvl, as_list=self.count)
-            curr_shg_vect = np.zeros((self.vect_size,))
-            for shg in found_shingles:
-                curr_shg_vect[self.get_desc_id(shg)] += 1
 
-            # Setting current descriptor in matrix
-            desc[i] = curr_shg_vect
+@functools.lru_cache(maxsize=None)
+def _get_numba_gaussian_fill():
+    """
+    Returning the Numba kernel that fills a matrix with Gaussian random values in parallel. Numba is imported and the
+    kernel is compiled at first call only, so that Numba is only required when this backend is used.
+    :return: Numba function fill(out, mu, sigma)
+    """
+    from numba import njit, prange
 
-        return desc, np.full((len(X),), True)
+    @njit(parallel=True)
+    def fill(out, mu, sigma):
+        for i in prange(out.shape[0]):
+            for j in range(out.shape[1]):
+                out[i, j] = mu + sigma * np.random.randn()
+
+    return fill
 
 
 class RandomGaussianVectorDesc(Descriptor):
 
-    def __init__(self, cache_location=None, mu=0, sigma=1, vect_size=4000):
+    def __init__(self, cache_location=None, mu=0, sigma=1, vect_size=4000, dtype=np.float32, backend="numpy",
+                 packed_successes=False):
         """
         Gaussian random descriptor
         :param mu: mean of the Gaussian distribution
         :param sigma: standard deviation of the Gaussian distribution
         :param vect_size: size of the descriptor
+        :param dtype: data type of the descriptors (np.float32 or np.float64)
+        :param backend: library used to draw the descriptors in transform. Options :
+            - "numpy" : single-threaded numpy generator
+            - "numba" : multithreaded Numba kernel (requires numba)
+            - "cupy" : generation on GPU (requires cupy)
+        :param packed_successes: whether to return the successes as a packed bitmap (see bool_mask)
         """
 
-        super().__init__(cache_location=cache_location)
+        super().__init__(cache_location=cache_location, dtype=dtype, packed_successes=packed_successes)
         self.mu = mu
         self.sigma = sigma
         self.vect_size = vect_size
+        self.backend = backend
+
+        # Random generator shared by all the calls to avoid relying on the numpy global state
+        self._rng = np.random.default_rng()
 
     def get_row_size(self):
         return self.vect_size
@@ -513,5 +1087,26 @@ class RandomGaussianVectorDesc(Descriptor):
         return self.vect_size
 
     def transform_row(self, smiles):
-        return np.random.normal(self.mu, self.sigma, self.vect_size), True
+        return self._rng.normal(self.mu, self.sigma, self.vect_size).astype(self.dtype, copy=False), True
+
+    def transform(self, X):
+
+        # The descriptors do not depend on the SMILES, so they are all drawn at once
+        if self.backend == "numpy":
+            desc = self._rng.standard_normal((len(X), self.vect_size), dtype=self.dtype)
+            desc *= self.sigma
+            desc += self.mu
+
+        elif self.backend == "numba":
+            desc = np.empty((len(X), self.vect_size), dtype=self.dtype)
+            _get_numba_gaussian_fill()(desc, self.mu, self.sigma)
+
+        elif self.backend == "cupy":
+            import cupy as cp
+            desc = cp.random.normal(self.mu, self.sigma, (len(X), self.vect_size), dtype=self.dtype).get()
+
+        else:
+            raise ValueError("Unknown backend : " + str(self.backend))
+
+        return desc, self.format_successes(np.full((len(X),), True))
 
@@ -0,0 +1,14 @@
+import numpy as np
+
+from chemdesc import CoulombMatrixDesc, bool_mask
+
+# Unparsable SMILES are reported as failed computations
+smiles = ["C", "CN", "invalid", "CF", "O=O", "CC", "CCO", "CNF", "CCC"]
+
+desc, packed_success = CoulombMatrixDesc(packed_successes=True).fit_transform(smiles)
+_, success = CoulombMatrixDesc().fit_transform(smiles)
+
+print(packed_success)
+print(bool_mask(packed_success, len(smiles)))
+print(success)
+print(np.array_equal(bool_mask(packed_success, len(smiles)), success))
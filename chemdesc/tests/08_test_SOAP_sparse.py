@@ -0,0 +1,12 @@
+import numpy as np
+
+from chemdesc import SOAPDesc
+
+s = SOAPDesc(average="off", sparse=True)
+desc, success = s.fit_transform(["CNF", "CC"])
+print(type(desc))
+print(desc.shape)
+print(desc.nnz)
+print(success)
+
+print(np.allclose(desc.toarray(), SOAPDesc(average="off").fit_transform(["CNF", "CC"])[0]))
@@ -0,0 +1,13 @@
+import numpy as np
+
+from chemdesc import CoulombMatrixDesc
+
+if __name__ == "__main__":
+
+    smiles = ["C", "CN", "CF", "CNF", "CCO"]
+
+    desc_pool, success_pool = CoulombMatrixDesc(geometry_backend="process_pool", n_jobs=2).fit_transform(smiles)
+    desc_joblib, success_joblib = CoulombMatrixDesc(n_jobs=2).fit_transform(smiles)
+
+    print(success_pool)
+    print(np.allclose(desc_pool, desc_joblib))
@@ -0,0 +1,13 @@
+import numpy as np
+
+from chemdesc import RandomGaussianVectorDesc
+
+for backend in ["numpy", "numba", "cupy"]:
+
+    try:
+        desc, success = RandomGaussianVectorDesc(vect_size=100000, backend=backend).fit_transform(["C", "CN", "CF"])
+        print(backend + " : " + str(type(desc)) + " " + str(desc.shape))
+        print(np.mean(desc, axis=1))
+        print(np.std(desc, axis=1))
+    except ImportError as e:
+        print(backend + " not available : " + str(e))
@@ -0,0 +1,12 @@
+import numpy as np
+
+from chemdesc import ShinglesVectDesc
+
+smiles = ["C", "C", "CN", "NC", "CF"]
+
+desc_sparse, success = ShinglesVectDesc(vect_size=30, count=True, sparse_output=True).fit_transform(smiles)
+desc_dense, _ = ShinglesVectDesc(vect_size=30, count=True, sparse_output=False).fit_transform(smiles)
+
+print(type(desc_sparse))
+print(desc_dense)
+print(np.array_equal(desc_sparse.toarray(), desc_dense))
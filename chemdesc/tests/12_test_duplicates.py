@@ -0,0 +1,13 @@
+import numpy as np
+
+from chemdesc import CoulombMatrixDesc
+
+s = CoulombMatrixDesc()
+
+smiles = ["C", "C", "CN", "NC", "CF"]
+desc, success = s.fit_transform(smiles)
+print(success)
+
+# Duplicates (same canonical SMILES) must share the descriptor computed molecule by molecule
+for i, smi in enumerate(smiles):
+    print(smi + " : " + str(np.allclose(desc[i], s.transform_row(smi)[0])))